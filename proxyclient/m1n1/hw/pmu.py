@@ -29,8 +29,9 @@ class PMU:
         for child in adt["/arm-io"]:
             if child.name.startswith("nub-spmi"):
                 for pmu in child:
-                    compat = getattr(pmu, "compatible")[0] if hasattr(pmu, "compatible") else "unset"
-                    primary = (getattr(pmu, "is-primary") == 1) if hasattr(pmu, "is-primary")  else False
-                    if compat == "pmu,spmi" and primary:
+                    compat = getattr(pmu, "compatible", None)
+                    if compat is None or compat[0] != "pmu,spmi":
+                        continue
+                    if getattr(pmu, "is-primary", None) == 1:
                         return pmu._path.removeprefix('/device-tree')
         raise KeyError(f"primary 'pmu,spmi' node not found")
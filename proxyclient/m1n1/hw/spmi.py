@@ -1,5 +1,6 @@
 # SPDX-License-Identifier: MIT
 import struct
+from contextlib import contextmanager
 
 from ..utils import *
 
@@ -13,6 +14,11 @@ CMD_WRITE       = 0x40
 CMD_READ        = 0x60
 CMD_ZERO_WRITE  = 0x80
 
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_U64 = struct.Struct("<Q")
+
 class R_CMD(Register32):
     REG         = 31, 16
     ACTIVE      = 15
@@ -25,6 +31,11 @@ class R_STATUS(Register32):
     TX_EMPTY    = 8
     TX_COUNT    = 7, 0
 
+# Raw equivalent of R_CMD, used on the command path to avoid building a
+# Register32 object for every transaction
+def _pack_cmd(reg, active, slave, cmd):
+    return ((reg & 0xffff) << 16) | ((active & 1) << 15) | ((slave & 0x7f) << 8) | (cmd & 0xff)
+
 class SPMIRegs(RegMap):
     STATUS      = 0x00, R_STATUS
     CMD         = 0x04, R_CMD
@@ -32,67 +43,185 @@ class SPMIRegs(RegMap):
     IRQ_FLAG    = 0x80, Register32
 
 class SPMI:
+    # Extended register long commands, indexed by size - 1
+    _EXT_READL_CMD = tuple(CMD_EXT_READL | i for i in range(8))
+    _EXT_WRITEL_CMD = tuple(CMD_EXT_WRITEL | i for i in range(8))
+    # Conservative TX/RX FIFO depth in words, enough for any single command
+    # and its reply; queued commands only wait for the controller beyond it
+    _FIFO_WORDS = 8
+
     def __init__(self, u, adt_path):
         self.u = u
         self.p = u.proxy
         self.iface = u.iface
         self.base = u.adt[adt_path].get_reg(0)[0]
         self.regs = SPMIRegs(u, self.base)
+        self._status_off = self.base + 0x00
+        self._cmd_off = self.base + 0x04
+        self._reply_off = self.base + 0x08
+        self._batch = None
+
+    def _poll_rx(self):
+        # Waits for at least one reply word and returns RX_COUNT, so callers
+        # can drain without polling again
+        timeout = 10000
+        count = (self.p.read32(self._status_off) >> 16) & 0xff
+        while not count and timeout > 0:
+            count = (self.p.read32(self._status_off) >> 16) & 0xff
+            timeout -= 1
+        if not count:
+            raise Exception("timeout")
+        return count
+
+    def read_replies(self, count):
+        # Each STATUS read tells us how many words are queued, so drain
+        # all of them before polling again.
+        vals = []
+        while len(vals) < count:
+            avail = min(self._poll_rx(), count - len(vals))
+            for _ in range(avail):
+                vals.append(self.p.read32(self._reply_off))
+        return vals
+
+    @contextmanager
+    def batch(self):
+        # read() and write() inside the block only queue their commands and
+        # return None. On exit the commands are issued back to back, polling
+        # STATUS only when a FIFO could overflow, and the yielded list is
+        # filled with their results, in order.
+        assert self._batch is None
+        self._batch = []
+        results = []
+        try:
+            yield results
+        finally:
+            batch, self._batch = self._batch, None
+        results += self._run(batch)
+
+    def _drain(self, report):
+        while not (self.p.read32(self._status_off) >> 24) & 1:
+            v = self.p.read32(self._reply_off)
+            if report:
+                print(">", v)
+
+    def _wait_fifo(self, vals, nwords, expected):
+        # Waits until nwords more fit in the command FIFO and the replies
+        # still outstanding fit in the RX FIFO, collecting replies meanwhile.
+        # Returns TX_COUNT.
+        timeout = 10000
+        while timeout > 0:
+            status = self.p.read32(self._status_off)
+            for _ in range((status >> 16) & 0xff):
+                vals.append(self.p.read32(self._reply_off))
+            tx = status & 0xff
+            if tx + nwords <= self._FIFO_WORDS and expected - len(vals) <= self._FIFO_WORDS:
+                return tx
+            timeout -= 1
+        raise Exception("timeout")
+
+    def _run(self, batch):
+        if not batch:
+            return []
+
+        # Stale replies are only reported ahead of a read, as they always were
+        self._drain(batch[0][2])
+
+        # Words are sent back to back as long as the FIFOs can't overflow;
+        # tx is an upper bound on the words still in the command FIFO.
+        vals = []
+        tx = expected = 0
+        for cmds, _, _ in batch:
+            for words, count in cmds:
+                if (tx + len(words) > self._FIFO_WORDS or
+                    expected + count - len(vals) > self._FIFO_WORDS):
+                    tx = self._wait_fifo(vals, len(words), expected + count)
+                for v in words:
+                    self.p.write32(self._cmd_off, v)
+                tx += len(words)
+                expected += count
+
+        vals += self.read_replies(expected - len(vals))
+
+        results = []
+        for cmds, decode, _ in batch:
+            n = sum(count for _, count in cmds)
+            results.append(decode(vals[:n]))
+            vals = vals[n:]
+        return results
+
+    def _submit(self, cmds, decode, report=False):
+        # cmds is a sequence of (command words, reply word count)
+        if self._batch is not None:
+            self._batch.append((cmds, decode, report))
+            return None
+
+        return self._run([(cmds, decode, report)])[0]
 
     def read(self, slave, reg, size):
-        while not self.regs.STATUS.reg.RX_EMPTY:
-            print(">", self.regs.REPLY.val)
-
-        self.regs.CMD.reg = R_CMD(REG = reg, ACTIVE=1, SLAVE_ID = slave, CMD = CMD_EXT_READL | (size - 1))
-
-        buf = b""
-
-        left = size + 4
-        while left > 0:
-            while self.regs.STATUS.reg.RX_EMPTY:
-                pass
-            v = self.regs.REPLY.val
-            buf += struct.pack("<I", v)
-            left -= 4
-
-        return buf[4:4+size]
+        assert size >= 1 and reg + size <= 0x10000
+        # Split into 8-byte extended-long commands on consecutive registers
+        frags = [(off, min(8, size - off)) for off in range(0, size, 8)]
+
+        def decode(vals):
+            # Drop each command's reply header; only the last fragment can
+            # be partial, so trimming the packed result is enough.
+            data = []
+            pos = 0
+            for _, n in frags:
+                count = (n + 7) // 4
+                data += vals[pos + 1:pos + count]
+                pos += count
+
+            return struct.pack(f"<{len(data)}I", *data)[:size]
+
+        cmds = [((_pack_cmd(reg + off, 1, slave, self._EXT_READL_CMD[n - 1]),), (n + 7) // 4)
+                for off, n in frags]
+        return self._submit(cmds, decode, report=True)
 
     def write(self, slave, reg, data):
-        while not self.regs.STATUS.reg.RX_EMPTY:
-            self.regs.REPLY.val
-
         size = len(data)
-        self.regs.CMD.reg = R_CMD(REG = reg, ACTIVE=1, SLAVE_ID = slave, CMD = CMD_EXT_WRITEL | (size - 1))
+        assert size >= 1 and reg + size <= 0x10000
 
-        while data:
-            blk = (data[:4] + b"\0\0\0")[:4]
-            self.regs.CMD.val = struct.unpack("<I", blk)[0]
-            data = data[4:]
+        # Split into 8-byte extended-long commands on consecutive registers
+        cmds = []
+        for off in range(0, size, 8):
+            blk = data[off:off + 8]
+            n = (len(blk) + 3) // 4
+            cmd = _pack_cmd(reg + off, 1, slave, self._EXT_WRITEL_CMD[len(blk) - 1])
+            cmds.append(((cmd,) + struct.unpack(f"<{n}I", blk.ljust(n * 4, b"\0")), 1))
 
-        while self.regs.STATUS.reg.RX_EMPTY:
-            pass
-        return self.regs.REPLY.val
+        # Returns the reply word, or the list of reply words (one per
+        # command) for writes longer than 8 bytes
+        return self._submit(cmds, lambda vals: vals[0] if len(vals) == 1 else vals)
 
     def read8(self, slave, reg):
-        return struct.unpack("<B", self.read(slave, reg, 1))[0]
+        assert self._batch is None
+        return self.read(slave, reg, 1)[0]
 
     def read16(self, slave, reg):
-        return struct.unpack("<H", self.read(slave, reg, 2))[0]
+        assert self._batch is None
+        return _U16.unpack(self.read(slave, reg, 2))[0]
 
     def read32(self, slave, reg):
-        return struct.unpack("<I", self.read(slave, reg, 4))[0]
+        assert self._batch is None
+        return _U32.unpack(self.read(slave, reg, 4))[0]
 
     def read64(self, slave, reg):
-        return struct.unpack("<Q", self.read(slave, reg, 8))[0]
+        assert self._batch is None
+        return _U64.unpack(self.read(slave, reg, 8))[0]
 
     def write8(self, slave, reg, val):
-        return self.write(slave, reg, struct.pack("<B", val))
+        assert self._batch is None
+        return self.write(slave, reg, _U8.pack(val))
 
     def write16(self, slave, reg, val):
-        return self.write(slave, reg, struct.pack("<H", val))
+        assert self._batch is None
+        return self.write(slave, reg, _U16.pack(val))
 
     def write32(self, slave, reg, val):
-        return self.write(slave, reg, struct.pack("<I", val))
+        assert self._batch is None
+        return self.write(slave, reg, _U32.pack(val))
 
     def write64(self, slave, reg, val):
-        return self.write(slave, reg, struct.pack("<Q", val))
+        assert self._batch is None
+        return self.write(slave, reg, _U64.pack(val))